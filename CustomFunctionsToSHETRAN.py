@@ -10,6 +10,12 @@ This class contains the following functions (modules):
     - NetCDFToSHETRAN           # Wrangles NetCDF data into SHETRAN format
     - WFDE5NetCDFClipper        # Clips raw WFDE5 data in NetCDF format to extent of interest
     - ASCtoDfParam              # Reads in ASC data and writes as DataFrame
+    - WFDE5ToDf                 # Clips and wrangles one WFDE5 monthyear file into a DataFrame
+    - WFDE5ToDfXarray           # Clips and wrangles all WFDE5 monthyear files into a DataFrame, lazily with xarray
+    - NearestIdx                # Finds index of the closest value in a monotonic axis (e.g. lat, lon)
+    - ConvertRound              # Converts units and rounds an array to 1 dp in a single pass
+    - SetNumbaThreads           # Limits threads used by ConvertRound, e.g. in each worker process
+    - DfToCSV                   # Writes DataFrame to CSV, buffered
         
 """
 
@@ -18,6 +24,16 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from netCDF4 import Dataset                                                     # Package index page https://pypi.org/project/netCDF4/
 
+try:
+    from numba import njit, prange, set_num_threads                             # Optional, for fused unit conversion https://pypi.org/project/numba/
+except ImportError:
+    njit = None
+
+try:
+    import xarray as xr                                                         # Optional, for lazy multi-file processing https://pypi.org/project/xarray/
+except ImportError:
+    xr = None
+
 
 #%%
 # Plots a variable in space and time
@@ -62,7 +78,7 @@ def NetCDFPlotter(Variable,
 
 
 #%%
-# Wrangles NetCDF data into CSV format for SHETRAN
+# Wrangles NetCDF data into DataFrame (and optionally CSV) format for SHETRAN
 # NB numbers cells ascending from Row 0 to Row N, Col 0 to Col N
 # NB for ERA5 , this is north to south, west to east
 # NB for WFDE5, this is south to north, west to 
@@ -77,37 +93,53 @@ def NetCDFToSHETRAN(Data,
                     Path,
                     File,
                     UnitConversion,
+                    WriteCSV=False,
                     ):
-    # Unmask NoData cells
-    for k in Data.variables:
-          Data.variables[k].set_auto_mask(False)
-    
-    # Loop through each cell in grid (e.g. 53 cols, 72 rows = 3816 cells)
-    NCols = len(Data.variables[LongitudeName])
-    NRows = len(Data.variables[LatitudeName])
-    
-    VarTimeSeriesCells = []
-    
-    for Lat in range(NRows):                                                    # Loop through Lat
-        for Lon in range(NCols):                                                # Loop through Lon
-            #CellNo = 1 + Lat * NCols + Lon                                     # Initialise at 1, then count position in grid
-            #print('CellNo', CellNo, 'Lat', Lat,'Lon', Lon)                     # Print to check numbering makes sense
-            VarTimeSeries = Data.variables[Variable][:,Lat,Lon]
-            VarTimeSeries = VarTimeSeries * UnitConversion                      # Convert
-            VarTimeSeries = np.round(VarTimeSeries,1)
-            #print(VarTimeSeries)
-            VarTimeSeriesCells.append(VarTimeSeries)
-    #print('NetCDFToSHETRAN: Loop finished')
-    
-    # Add to Df and add datetime index
-    DfVarTimeSeriesCells = pd.DataFrame(data = VarTimeSeriesCells).transpose()
-    DfVarTimeSeriesCells.index = Data.variables['time'][:]                     # Add datetime index integer, to allow time series concatenation
+    # Data is either a NetCDF Dataset, or a (Variable array, time array) tuple already in memory
+    if isinstance(Data, tuple):
+        VarDataRaw, Time = Data
+        NRows, NCols     = VarDataRaw.shape[1:]                                 # Grid size (e.g. 53 cols, 72 rows = 3816 cells)
+    else:
+        # Unmask NoData cells, for all variables at once (NB also disables scaling, as Rainf is not packed)
+        Data.set_auto_maskandscale(False)
+        Data.set_always_mask(False)
+        
+        # Grid size (e.g. 53 cols, 72 rows = 3816 cells)
+        NCols = len(Data.variables[LongitudeName])
+        NRows = len(Data.variables[LatitudeName])
+        
+        # Read blocks of rows below, rather than one time series per cell
+        VarDataRaw  = Data.variables[Variable]
+        Time        = Data.variables['time'][:]
+
+    # Convert and round to 1 dp, as float32, in blocks of whole rows of ~512 KB, so each block stays in cache
+    # Whole rows keep each block's cells contiguous in the cell numbering below
+    TimeLen     = VarDataRaw.shape[0]
+    RowBlock    = max(1, 2**19 // (TimeLen * NCols * np.dtype(np.float32).itemsize))
+
+    # Flatten (time, lat, lon) to (time, cell). C-order numbers cells Lat-major, Lon-minor
+    # Fortran order makes each cell's time series contiguous, as pandas stores by column
+    #CellNo = 1 + Lat * NCols + Lon                                             # Initialise at 1, then count position in grid
+    VarTimeSeriesCells = np.empty((TimeLen, NRows * NCols), dtype=np.float32, order='F')
+    for Row in range(0, NRows, RowBlock):                                       # Loop through blocks of Lat
+        RowEnd  = min(Row + RowBlock, NRows)
+        VarData = ConvertRound(np.asarray(VarDataRaw[:, Row:RowEnd, :], dtype=np.float32),
+                               UnitConversion)
+        VarTimeSeriesCells[:, Row * NCols:RowEnd * NCols] = VarData.reshape(TimeLen, -1)
+
+    # Add to Df (already time x cell, so no transpose needed) and add datetime index
+    # Df wraps the array as its single block without copying, as it is already column-major
+    DfVarTimeSeriesCells = pd.DataFrame(data = VarTimeSeriesCells,
+                                        index = Time,                           # Add datetime index integer, to allow time series concatenation
+                                        copy = False)
     DfVarTimeSeriesCells.index = Dates                                          # Add datetime index DateTime, to allow time series concatenation
     #print('NetCDFToSHETRAN: Var time series added to df')
 
 
-    # Write Df to CSV (where each cell has its own col, ready for SHETRAN)
-    DfVarTimeSeriesCells.to_csv(path_or_buf=(Path + File))
+    # Optionally write Df to CSV (where each cell has its own col, ready for SHETRAN)
+    if WriteCSV:
+        DfToCSV(Df          = DfVarTimeSeriesCells,
+                PathFile    = Path + File)
     #print('NetCDFToSHETRAN: Df written to CSV')
     
     return DfVarTimeSeriesCells
@@ -115,28 +147,33 @@ def NetCDFToSHETRAN(Data,
 
 #%%
 # Clip WFDE5 NetCDF data from globe to specified extent
+# Returns the clipped Rainf and time arrays, and optionally writes them to FileClipped
 def WFDE5NetCDFClipper(Path,
                        FileRaw,
                        IdxWest,
                        IdxEast,
                        IdxNorth,
                        IdxSouth,
-                       FileClipped
+                       FileClipped=None,
                        ):
     # From raw WFDE5 NetCDF data, extract arrays of each variable and clip to extent of interest
     WFDE5ClipTime    = FileRaw.variables['time'][:]
     WFDE5ClipLon     = FileRaw.variables['lon'][IdxWest:IdxEast]
     WFDE5ClipLat     = FileRaw.variables['lat'][IdxSouth:IdxNorth]
     WFDE5ClipRainf   = FileRaw.variables['Rainf'][:,IdxSouth:IdxNorth,IdxWest:IdxEast]
+    WFDE5ClipRainf   = WFDE5ClipRainf.astype(np.float32)                        # float32 is ample precision for Rainf, and halves I/O and memory
+    
+    if FileClipped is None:                                                     # Keep in memory only
+        return WFDE5ClipRainf, WFDE5ClipTime
     
     # Create blank NetCDF root group to store clipped data array
     WFDE5Clip = Dataset(FileClipped, "w", format="NETCDF4")
     
-    # Within the root group, create blank dimension names (time, lon, lat, Rainf) of any size
-    WFDE5Clip.createDimension('time',  None)
-    WFDE5Clip.createDimension('lon',   None)
-    WFDE5Clip.createDimension('lat',   None)
-    WFDE5Clip.createDimension('Rainf', None)
+    # Within the root group, create dimension names sized to clipped extent, so HDF5 can pre-allocate chunks
+    TimeLen, LatLen, LonLen = WFDE5ClipRainf.shape
+    WFDE5Clip.createDimension('time',  TimeLen)
+    WFDE5Clip.createDimension('lon',   LonLen)
+    WFDE5Clip.createDimension('lat',   LatLen)
     
     # Populate variable dimensions with clipped data
     VarTime     = WFDE5Clip.createVariable('time', 'int',     ('time'));
@@ -151,13 +188,24 @@ def WFDE5NetCDFClipper(Path,
     #VarLat[:]   = WFDE5ClipLat
     VarLat.setncattr('units','degrees_north');VarLat[:] = WFDE5ClipLat
     
-    VarRainf    = WFDE5Clip.createVariable('Rainf','float',   ('Rainf','lat','lon'));
-    VarRainf.setncattr('units','kg m-2 s-1');VarRainf[:] = WFDE5ClipRainf
+    # Chunk Rainf as whole time series for square blocks of cells, to suit reading by cell, and compress
+    # Block size targets chunks of ~1 MB (at least 4 x 4 cells)
+    ChunkCells  = max(4, int(np.sqrt(2**20 / (TimeLen * WFDE5ClipRainf.dtype.itemsize))))
+    VarRainf    = WFDE5Clip.createVariable('Rainf','f4',      ('time','lat','lon'),
+                                           chunksizes  = (TimeLen, min(ChunkCells, LatLen), min(ChunkCells, LonLen)),
+                                           zlib        = True,
+                                           complevel   = 1,
+                                           shuffle     = True,
+                                           fill_value  = getattr(FileRaw.variables['Rainf'], '_FillValue', None));   # Keep NoData flagged as missing
+    VarRainf.setncattr('units','kg m-2 s-1')
+    VarRainf[0:TimeLen, 0:LatLen, 0:LonLen] = WFDE5ClipRainf                    # Write in one slab, so each chunk is compressed once
     
     # Close WFDE5Clip NetCDF file
     WFDE5Clip.close()
     
     print('WFDE5NetCDFClipper: Clipped WFDE5 written to:', Path + FileClipped)
+    
+    return WFDE5ClipRainf, WFDE5ClipTime
 
 
 #%%
@@ -165,26 +213,154 @@ def WFDE5NetCDFClipper(Path,
 def ASCtoDfParam(Path,
                  Nrows,
                  Ncols):
-    with open(Path) as File:                                                    # Read in each line from file
-        Lines = File.readlines()
-        Lines = [Line.rstrip() for Line in Lines]
-        
-    # Remove metadata rows
-    Lines = Lines [6:]
+    # Read values in one pass, skipping metadata rows (Nrows, Ncols kept for compatibility)
+    DfParam = pd.DataFrame(np.loadtxt(Path, skiprows=6, dtype=np.float64, ndmin=2))
     
-    # Create blank DfParam to store values at x and y
-    DfParam = pd.DataFrame(np.zeros([Nrows,Ncols]))
+    return(DfParam)
+
+
+#%%
+# Clips one raw WFDE5 monthyear file and wrangles it into a daily DataFrame
+# NB opens the NetCDF files itself, as Datasets cannot be passed between worker processes
+def WFDE5ToDf(File,
+              DirectoryRaw,
+              DirectoryClipped,
+              ExtIn,
+              IdxWest,
+              IdxEast,
+              IdxNorth,
+              IdxSouth,
+              UnitConversion,
+              WriteClipped=False,
+              ):
+    # Clip in memory, rather than writing and re-reading a clipped NetCDF (optionally archived as <WFDE5Clip>.nc)
+    WFDE5 = Dataset(DirectoryRaw + File + ExtIn)
+    WFDE5.set_auto_mask(False)                                                  # Keep NoData values, as they are replaced after aggregation
+    WFDE5ClipRainf, WFDE5ClipTime = WFDE5NetCDFClipper(Path         = DirectoryClipped,
+                                                       FileRaw      = WFDE5,
+                                                       IdxWest      = IdxWest,
+                                                       IdxEast      = IdxEast,
+                                                       IdxNorth     = IdxNorth,
+                                                       IdxSouth     = IdxSouth,
+                                                       FileClipped  = DirectoryClipped + File + '_Clip' + ExtIn if WriteClipped else None)
+    WFDE5.close()
     
-    # Split out each parameter string (Ncols) in each line string (Nrows)
-    for Line in range(len(Lines)):                                              # Loop over lines
-        ColList = (Lines[Line].split())                                         # ColList is a list of string parameters in a line
-        
-        for Col in range(len(ColList)):                                         # Loop over Cols
-            ParamStr                = ColList[Col]                              # ParamStr is a parameter string for a given col in a line
-            DfParam.iloc[Line,Col]  = ParamStr                                  # Write to DfParam
-        
-    # Convert parameter strings to floats
-    DfParam.iloc[:,:] = np.float64(DfParam.iloc[:,:])
+    Dates       = pd.to_datetime(np.asarray(WFDE5ClipTime).astype('int64'),     # Units are whole hours since 1900-01-01 00:00:00
+                                 unit   = 'h',
+                                 origin = '1900-01-01')
+    DfVarTimeSeriesCells = NetCDFToSHETRAN(Data            = (WFDE5ClipRainf, WFDE5ClipTime),
+                                           Dates           = Dates,
+                                           Variable        = 'Rainf',
+                                           LongitudeName   = 'lon',
+                                           LatitudeName    = 'lat',
+                                           Path            = DirectoryClipped,
+                                           File            = File + '_Clip.csv',
+                                           UnitConversion  = UnitConversion,
+                                           )
     
-    return(DfParam)
+    # Aggregate from hourly to daily, so the master Df is built from 24x fewer rows
+    DfVarTimeSeriesCells = DfVarTimeSeriesCells.resample('D').sum()
+    
+    return DfVarTimeSeriesCells
+
 
+#%%
+# Clips all raw WFDE5 monthyear files and wrangles them into a single daily DataFrame, as WFDE5ToDf does per file
+# xarray opens all files as one lazy dask array, so clipping, conversion and aggregation run as one parallel computation
+def WFDE5ToDfXarray(PathListNC,
+                    IdxWest,
+                    IdxEast,
+                    IdxNorth,
+                    IdxSouth,
+                    UnitConversion,
+                    ):
+    if xr is None:
+        raise ImportError('WFDE5ToDfXarray requires xarray and dask')
+    
+    WFDE5   = xr.open_mfdataset(PathListNC,
+                                combine         = 'by_coords',
+                                chunks          = {'time': 744},                # At most 744 hours (31 days), so one chunk per monthyear file
+                                mask_and_scale  = False)                        # Keep NoData values, as they are replaced after aggregation
+    Rainf   = WFDE5['Rainf'].isel(lat = slice(IdxSouth, IdxNorth),
+                                  lon = slice(IdxWest, IdxEast))
+    
+    # Convert and round to 1 dp, as float32, then aggregate from hourly to daily
+    Rainf   = (Rainf.astype(np.float32) * np.float32(UnitConversion)).round(1)
+    Rainf   = Rainf.resample(time='1D').sum().compute()                         # NB days between non-consecutive monthyears are all NaN
+    WFDE5.close()
+    
+    # Flatten (time, lat, lon) to (time, cell), numbering cells as NetCDFToSHETRAN does
+    TimeLen = Rainf.shape[0]
+    DfVarTimeSeriesCells = pd.DataFrame(data  = np.asfortranarray(Rainf.values.reshape(TimeLen, -1)),
+                                        index = Rainf['time'].to_index().rename(None),   # Unnamed, as WFDE5ToDf
+                                        copy  = False)
+    
+    return DfVarTimeSeriesCells
+
+
+#%%
+# Finds index of the closest value in a monotonic (ascending or descending) axis, as np.abs(Axis - Value).argmin() does
+# Uses a binary search, so avoids allocating and scanning a copy of the axis
+def NearestIdx(Axis,
+               Value):
+    Axis        = np.asarray(Axis)
+    if len(Axis) == 1:                                                          # Only one value to choose
+        return 0
+    Descending  = Axis[0] > Axis[-1]
+    AxisSorted  = Axis[::-1] if Descending else Axis                            # searchsorted needs ascending values
+    
+    Idx         = int(np.clip(np.searchsorted(AxisSorted, Value), 1, len(AxisSorted) - 1))
+    DistLower   = Value - AxisSorted[Idx - 1]
+    DistUpper   = AxisSorted[Idx] - Value
+    if DistLower < DistUpper or (DistLower == DistUpper and not Descending):   # On ties, keep the first index in the original axis
+        Idx    -= 1
+    
+    return len(AxisSorted) - 1 - Idx if Descending else Idx
+
+
+#%%
+# Converts units and rounds a (time, lat, lon) array to 1 dp, returning a new array of the same dtype
+# With Numba, both steps are fused into one parallel pass over the array, otherwise NumPy makes two passes
+def _ConvertRoundNumPy(VarData,
+                       UnitConversion):
+    VarDataConv = VarData * VarData.dtype.type(UnitConversion)
+    np.round(VarDataConv, 1, out=VarDataConv)
+    return VarDataConv
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _ConvertRoundNumba(VarData,
+                           UnitConversion,
+                           Ten):
+        VarDataConv = np.empty_like(VarData)
+        for i in prange(VarData.shape[0]):                                      # Loop through time, in parallel
+            for j in range(VarData.shape[1]):                                   # Loop through Lat
+                for k in range(VarData.shape[2]):                               # Loop through Lon
+                    VarDataConv[i,j,k] = np.rint(VarData[i,j,k] * UnitConversion * Ten) / Ten       # As np.round(x, 1)
+        return VarDataConv
+
+
+def ConvertRound(VarData,
+                 UnitConversion):
+    if njit is not None and VarData.ndim == 3:
+        Dtype = VarData.dtype.type                                              # Keep arithmetic in the array's dtype, as NumPy does
+        return _ConvertRoundNumba(VarData, Dtype(UnitConversion), Dtype(10))
+    return _ConvertRoundNumPy(VarData, UnitConversion)
+
+
+# Limits threads used by ConvertRound, so (worker processes x threads) does not exceed the cores available
+# Use as a ProcessPoolExecutor initializer, e.g. initializer=SetNumbaThreads, initargs=(1,)
+def SetNumbaThreads(NThreads):
+    if njit is not None:
+        set_num_threads(NThreads)
+
+
+#%%
+# Writes DataFrame to CSV, as pandas to_csv does, through a large buffer with Unix line endings
+def DfToCSV(Df,
+            PathFile,
+            ):
+    with open(PathFile, 'wb', buffering=2**20) as FileCSV:                      # Large buffer cuts syscalls, binary mode avoids newline translation
+        Df.to_csv(path_or_buf    = FileCSV,
+                  lineterminator = '\n')
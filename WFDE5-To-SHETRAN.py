@@ -9,10 +9,9 @@ This script:
     - Reads downloaded WFDE5 NetCDF data for each monthyear
     - Plots WFDE5 data
     - Clips WFDE5 to data domain
-    - Writes clipped WFDE5 NetCDF files for each monthyear
-    - Reads clipped WFDE5 NetCDF files for each monthyear
-    - Creates CSVs of clipped WFDE5 for each monthyear
-    - Concatenates all clipped monthyear CSVs into a single CSV
+    - Wrangles clipped WFDE5 for each monthyear into DataFrames
+    - Optionally writes clipped WFDE5 NetCDF files for each monthyear
+    - Concatenates all clipped monthyear DataFrames into a single CSV
         
 File information:
     - WFDE5 files contain a single variable for a given month, 
@@ -30,6 +29,8 @@ The user must define:
     - 'DataVersion' which contains the version of the downloaded WFDE5 data, assumed to be in the filenames
     - 'ExtIn' which is the file extension of the downloaded WFDE5 data
     - 'DirectoryClipped' which is the location for writing clipped data
+    - 'WriteClipped' which sets whether clipped data are written as NetCDF
+    - 'UseXarray' which sets whether all monthyears are processed together with xarray
     - 'DirectoryConcat' which is the location for writing concatenated data
     - 'North'  which is the northern limit of the data domain
     - 'South' which is the southern limit of the data domain
@@ -47,6 +48,8 @@ DirectoryRaw        = ''
 DataVersion         = ''                                                        # Set to data version e.g. 'v2.1'
 ExtIn               = '.nc'                                                     # Set to data extension i.e. '.nc'
 DirectoryClipped    = ''                                                        # Set to location for writing clipped data
+WriteClipped        = False                                                     # Set to True to also archive clipped data as NetCDF
+UseXarray           = False                                                     # Set to True to process all monthyears lazily with xarray and dask (if installed)
 DirectoryConcat     = ''                                                        # Set to location for writing clipped concatenated data
 North               = 8.21                                                      # Northern limit of data domain (lat)
 South               = 1.09                                                      # Southern limit of data domain (lat)
@@ -57,16 +60,20 @@ East                = -57.67
 #%% Import modules and functions
 
 import os
-import numpy as np
 import pandas as pd
 import glob
 import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from netCDF4 import Dataset                                                     # Package index page documentation https://pypi.org/project/netCDF4/
 
 os.chdir(FunctionsLibrary)                                                      # Sets working directory to enable custom functions to be used
 from CustomFunctionsToSHETRAN import NetCDFPlotter
-from CustomFunctionsToSHETRAN import WFDE5NetCDFClipper
-from CustomFunctionsToSHETRAN import NetCDFToSHETRAN
+from CustomFunctionsToSHETRAN import WFDE5ToDf
+from CustomFunctionsToSHETRAN import WFDE5ToDfXarray
+from CustomFunctionsToSHETRAN import SetNumbaThreads
+from CustomFunctionsToSHETRAN import NearestIdx
 
 
 #%% Read in each monthyear and wrangle data
@@ -75,11 +82,8 @@ from CustomFunctionsToSHETRAN import NetCDFToSHETRAN
 PathListNC        = glob.glob(DirectoryRaw + '*' + DataVersion + ExtIn)         # Create list of files with full path names and extensions
 
 # Create list of file names only (without filepath or extension)
-FileNameList= []                                                                # Create blank list to store file names without extensions
-for Path in PathListNC:
-    FileName = Path.split('\\',-1)[1]                                           # Extract filename and extension from entire path
-    FileName = FileName.split(ExtIn,-1)[0]                                      # Extract filename without extension
-    FileNameList.append(FileName)
+FileNameList = [Path(PathNC).stem for PathNC in PathListNC]                     # Works with any path separator or directory depth
+FileNameList.sort(key=lambda FileName: FileName.split('_')[-2])                 # Sort by <yearmonth>, so monthyear DataFrames are concatenated in time order
     
 File        = FileNameList[0]
 WFDE5       = Dataset(DirectoryRaw + File + ExtIn)
@@ -98,10 +102,10 @@ Lons = WFDE5.variables['lon'][:]
 Lats = WFDE5.variables['lat'][:]
 
 # Get the index of the closest value to the easting and northing, plus 1 to cover domain
-IdxNorth    = (np.abs(Lats - North)).argmin() + 1
-IdxSouth    = (np.abs(Lats - South)).argmin()
-IdxWest     = (np.abs(Lons - West)).argmin()
-IdxEast     = (np.abs(Lons - East)).argmin() + 1
+IdxNorth    = NearestIdx(Lats, North) + 1
+IdxSouth    = NearestIdx(Lats, South)
+IdxWest     = NearestIdx(Lons, West)
+IdxEast     = NearestIdx(Lons, East) + 1
 
 # Define unit conversion (from kg/m-2/s-1 to mm/hour)
 SecsPerHour = 60**2
@@ -110,98 +114,79 @@ MmPerMetre  = 1000
 UnitConversion = SecsPerHour / KgPerCubicM * MmPerMetre
 #%% Plot map of time point, and time series of point
 
-# Call NetCDFPlotter function on clipped extent
-NetCDFPlotter(Variable          = 'Rainf',
-              Data              = WFDE5,
-              Time              = 250,                                          # Set for time point of map
-              Lon               = 244,                                          # Set for Lon of time series
-              Lat               = 190,                                          # Set for Lat of time series
-              South             = IdxSouth,                                     # Set 0=globe OR IdxSouth=domain
-              North             = IdxNorth,                                     # Set LatLen=globe OR IdxNorth=domain
-              West              = IdxWest,                                      # Set 0=globe OR IdxWest=domain
-              East              = IdxEast,                                      # Set LonLen0=globe OR IdxEast=domain
-              UnitConversion    = UnitConversion,
-              )
-
-
-#%% Clip WFDE5 data by returning array and write <WFDE5Clip>.nc, for all monthyear files
-
-TimeCount1 = time.perf_counter()
-
-for File in FileNameList:
-    WFDE5 = Dataset(DirectoryRaw + File + ExtIn)
-    WFDE5NetCDFClipper(Path         = DirectoryClipped,
-                       FileRaw      = WFDE5,
-                       IdxWest      = IdxWest,
-                       IdxEast      = IdxEast,
-                       IdxNorth     = IdxNorth,
-                       IdxSouth     = IdxSouth,
-                       FileClipped  = DirectoryClipped + File + '_Clip' + ExtIn)
-print('WFDE5NetCDFClipper: All NetCDF files clipped')
-
-TimeCount2 = time.perf_counter()
-
-print('Seconds taken = ', TimeCount2 - TimeCount1)
-
-
-#%% Wrangle <WFDE5Clip>.nc data into <WFDE5Clip>.csv format using NetCDFToSHETRAN function, for all files
-
-TimeCount1 = time.perf_counter()
-
-for File in FileNameList:
-    WFDE5Clip   = Dataset(DirectoryClipped + File + '_Clip' + ExtIn)
-    DfVarTimeSeriesCells = NetCDFToSHETRAN(Data            = WFDE5Clip,
-                                           Dates           = WFDE5Clip.variables['time'][:],
-                                           Variable        = 'Rainf',
-                                           LongitudeName   = 'lon',
-                                           LatitudeName    = 'lat',
-                                           Path            = DirectoryClipped,
-                                           File            = File + '_Clip.csv',
-                                           UnitConversion  = UnitConversion
-                                           )
-
-# Convert units (from kg/m-2/s-1 to mm/hour)
-DfVarTimeSeriesCells = DfVarTimeSeriesCells * UnitConversion
-
-TimeCount2 = time.perf_counter()
-print('seconds taken = ', TimeCount2 - TimeCount1)
-
-
-#%% Concatenate each monthyear's DataFrame into a master DataFrame and wrangle datetimes, time interval, and NoData values
-
-PathListCSV = glob.glob(DirectoryClipped + '*' + DataVersion + '_Clip.csv')     # Create list of files with full path names and extensions
-
-# Loop through each CSV in CSVPathList to create list of monthyear DataFrames
-DfList      = []
-for CSV in PathListCSV:
-    Df      = pd.read_csv(filepath_or_buffer    = CSV,
-                          index_col             = (0))
-    DfList.append(Df)
-
-# Concatenate all Dfs in list to master Df
-Mdf         = pd.concat(DfList)
-Mdf         = Mdf.sort_index(ascending = True)
-
-# Create datetime index (units are hours since 1900-01-01 00:00:00)
-DateIndex = pd.Series(pd.date_range(start='1900-01-01 00:00:00',
-                                    end = '2011-01-01 00:00:00',
-                                    freq = 'H'))
-
-# Set new date index to MDf by subsetting DateIndex to the first and late dates in Mdf
-MdfStart    = Mdf.index[0]
-MdfEnd      = Mdf.index[-1]+1
-Mdf.index   = DateIndex[MdfStart:MdfEnd]
-
-# Aggregate from hourly to daily
-Mdf = Mdf.resample('D').sum()
-
-# Change NoData numbers (in practice, > 1000) to 0.001
-Replacer = lambda x: 0.001 if x>1000 else x
-for Col in Mdf.columns:
-    Mdf[Col] = Mdf[Col].map(Replacer)
-
-# Write out Mdf to csv
-Mdf.to_csv(path_or_buf=(DirectoryConcat + 'Rainf_WFDE5_CRU+GPCC_2000-2010_v2.1_ClipConcat.csv'))
+# NB cells below are guarded, as worker processes re-import this script on Windows
+if __name__ == '__main__':
+    # Call NetCDFPlotter function on clipped extent
+    NetCDFPlotter(Variable          = 'Rainf',
+                  Data              = WFDE5,
+                  Time              = 250,                                      # Set for time point of map
+                  Lon               = 244,                                      # Set for Lon of time series
+                  Lat               = 190,                                      # Set for Lat of time series
+                  South             = IdxSouth,                                 # Set 0=globe OR IdxSouth=domain
+                  North             = IdxNorth,                                 # Set LatLen=globe OR IdxNorth=domain
+                  West              = IdxWest,                                  # Set 0=globe OR IdxWest=domain
+                  East              = IdxEast,                                  # Set LonLen0=globe OR IdxEast=domain
+                  UnitConversion    = UnitConversion,
+                  )
+
+
+#%% Clip WFDE5 data and wrangle into a daily DataFrame using NetCDFToSHETRAN, for all monthyear files
+
+if __name__ == '__main__':
+    TimeCount1 = time.perf_counter()
+
+    if UseXarray:
+        # Process all monthyears as one lazy computation (WriteClipped is not supported)
+        DfList = [WFDE5ToDfXarray(PathListNC        = PathListNC,
+                                  IdxWest           = IdxWest,
+                                  IdxEast           = IdxEast,
+                                  IdxNorth          = IdxNorth,
+                                  IdxSouth          = IdxSouth,
+                                  UnitConversion    = UnitConversion,
+                                  )]
+    else:
+        # Process monthyears in parallel, keeping each DataFrame in memory rather than round-tripping through CSV
+        WFDE5ToDfFile = partial(WFDE5ToDf,
+                                DirectoryRaw        = DirectoryRaw,
+                                DirectoryClipped    = DirectoryClipped,
+                                ExtIn               = ExtIn,
+                                IdxWest             = IdxWest,
+                                IdxEast             = IdxEast,
+                                IdxNorth            = IdxNorth,
+                                IdxSouth            = IdxSouth,
+                                UnitConversion      = UnitConversion,           # Convert units (from kg/m-2/s-1 to mm/hour)
+                                WriteClipped        = WriteClipped,
+                                )
+        with ProcessPoolExecutor(max_workers = os.cpu_count(),
+                                 initializer = SetNumbaThreads,                 # One Numba thread per worker, as the workers already use every core
+                                 initargs    = (1,)) as Executor:
+            DfList = list(Executor.map(WFDE5ToDfFile, FileNameList))
+    print('WFDE5ToDf: All NetCDF files clipped and wrangled')
+
+    TimeCount2 = time.perf_counter()
+    print('Seconds taken = ', TimeCount2 - TimeCount1)
+
+
+#%% Concatenate each monthyear's DataFrame into a master DataFrame and wrangle NoData values
+
+if __name__ == '__main__':
+    # Concatenate all Dfs in list to master Df (already in time order, as FileNameList is sorted)
+    Mdf         = pd.concat(DfList)
+    Mdf         = Mdf.dropna(how = 'all')                                       # Drop empty days, which WFDE5ToDfXarray creates between monthyears
+
+    # Check no monthyears are missing, as SHETRAN needs a continuous daily time series
+    DaysMissing = pd.date_range(start = Mdf.index[0],
+                                end   = Mdf.index[-1],
+                                freq  = 'D').difference(Mdf.index)
+    if len(DaysMissing) > 0:
+        raise ValueError('Monthyears missing from DirectoryRaw, e.g. no data for ' + str(DaysMissing[0].date())
+                         + ' (' + str(len(DaysMissing)) + ' days missing in total)')
+
+    # Change NoData numbers (in practice, > 1000) to 0.001
+    Mdf = Mdf.mask(Mdf > 1000, 0.001)
+
+    # Write out Mdf to csv
+    Mdf.to_csv(path_or_buf=(DirectoryConcat + 'Rainf_WFDE5_CRU+GPCC_2000-2010_v2.1_ClipConcat.csv'))
 
 
 